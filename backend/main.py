@@ -1,14 +1,25 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from flask_cors import CORS
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import requests
-import openai
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import httpx
+from openai import OpenAI
 import os
-import subprocess
+import hashlib
+import shutil
+import threading
+import uuid
+import logging
+import json
+from functools import lru_cache
 from dotenv import load_dotenv
+from sphinx.cmd.build import build_main
 
 load_dotenv()
+logger = logging.getLogger(__name__)
 app = FastAPI()
 # Enable CORS (Allow all origins, methods, and headers)
 app.add_middleware(
@@ -28,46 +39,145 @@ class RepoRequest(BaseModel):
     repoUrl: str
 
 GITINGEST_API = "https://api.gitingest.com/retrieve"
+GITINGEST_TIMEOUT = (5, 120)  # (connect, read) seconds; ingesting a large repo is slow
 GPT_MODEL = "gpt-4o"
+SYSTEM_PROMPT = "Analyze this code and generate Sphinx documentation."
+RST_CACHE_DIR = "rst_cache"
+# Bump to invalidate every cached RST entry (e.g. after a cache-format or write-path fix)
+RST_CACHE_VERSION = "v2"
+DOWNLOAD_URL = "http://localhost:5000/docs_build/index.html"
 
-@app.post("/generate-docs")
-def generate_docs(request: RepoRequest):
-    repo_url = request.repoUrl
+# build_main patches docutils/Sphinx globals while it runs and docs/index.rst is shared,
+# so only one request writes and builds at a time
+sphinx_build_lock = threading.Lock()
+
+# One pooled session for Gitingest so keep-alive connections are reused across requests.
+# Retrying the POST assumes retrieve is idempotent (it is only expected to read the repository).
+# read=0: a large repo that timed out once will most likely time out again, so read timeouts
+# are not retried; only connect errors and 429/5xx responses are.
+gitingest_session = requests.Session()
+gitingest_session.mount("https://", HTTPAdapter(
+    pool_maxsize=16,
+    max_retries=Retry(total=3, read=0, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=["POST"], raise_on_status=False)
+))
+
+@lru_cache(maxsize=1)
+def get_openai_client():
+    """Build the shared OpenAI client on first use, so a missing key only fails GPT-4o calls."""
+    # The SDK retries 429/5xx and connection errors itself with exponential backoff.
+    # Keep the SDK's 600s read timeout: a streamed answer over a whole repo dump can take
+    # minutes to start, and a stream that times out is not retried.
+    return OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        max_retries=5,
+        timeout=httpx.Timeout(600.0, connect=5.0)
+    )
 
+def run_pipeline(repo_url):
+    """Generate the docs for repo_url, yielding (event, data) after each step."""
     # 1. Fetch source code from GitHub using Gitingest API
-    response = requests.post(GITINGEST_API, json={"repo_url": repo_url})
+    response = gitingest_session.post(GITINGEST_API, json={"repo_url": repo_url},
+                                      timeout=GITINGEST_TIMEOUT)
     if response.status_code != 200:
         raise HTTPException(status_code=400, detail="Failed to retrieve source code")
     
     source_code = response.json().get("source_code")
     if not source_code:
         raise HTTPException(status_code=400, detail="No source code found")
+    yield "fetched", repo_url
 
     # 2. Save source code to a text file
     file_path = "repo_code.txt"
     with open(file_path, "w", encoding="utf-8") as f:
         f.write(source_code)
 
-    # 3. Send to GPT-4o for analysis
-    openai.api_key = os.getenv("OPENAI_API_KEY")
-    completion = openai.chat.completions.create(
-        model=GPT_MODEL,
-        messages=[{"role": "system", "content": "Analyze this code and generate Sphinx documentation."},
-                  {"role": "user", "content": source_code}]
-    )
-
-    doc_text = completion["choices"][0]["message"]["content"]
-
-    # 4. Save documentation as RST file for Sphinx
+    # 3. Send to GPT-4o for analysis, streaming the answer into the RST cache
     docs_path = "docs"
     os.makedirs(docs_path, exist_ok=True)
     rst_file = os.path.join(docs_path, "index.rst")
 
-    with open(rst_file, "w", encoding="utf-8") as f:
-        f.write(doc_text)
+    # Identical source code was already documented with the same model and prompt:
+    # reuse its RST and skip GPT-4o
+    cache_key = hashlib.sha256(f"{RST_CACHE_VERSION}|{GPT_MODEL}|{SYSTEM_PROMPT}|".encode("utf-8"))
+    cache_key.update(source_code.encode("utf-8"))
+    cached_rst = os.path.join(RST_CACHE_DIR, f"{cache_key.hexdigest()}.rst")
+    tmp_rst = f"{cached_rst}.{uuid.uuid4().hex}.tmp"
+    truncated = False
+    try:
+        if os.path.exists(cached_rst):
+            yield "rst_ready", {"source": "cached", "truncated": False}
+        else:
+            os.makedirs(RST_CACHE_DIR, exist_ok=True)
+            stream = get_openai_client().chat.completions.create(
+                model=GPT_MODEL,
+                messages=[{"role": "system", "content": SYSTEM_PROMPT},
+                          {"role": "user", "content": source_code}],
+                stream=True
+            )
 
-    # 5. Generate HTML documentation with Sphinx
-    subprocess.run(["sphinx-build", docs_path, "docs_build"])
+            # 4. Write each delta as it arrives instead of buffering the whole answer
+            finish_reason = None
+            with open(tmp_rst, "w", encoding="utf-8") as f:
+                for event in stream:
+                    if event.choices:
+                        choice = event.choices[0]
+                        f.write(choice.delta.content or "")
+                        finish_reason = choice.finish_reason or finish_reason
+
+            if finish_reason == "stop":
+                # Publish atomically so concurrent cache hits never read a partial file
+                os.replace(tmp_rst, cached_rst)
+            elif finish_reason == "length":
+                # Hit the output-token limit: still build the answer, but keep it out of the cache
+                truncated = True
+            else:
+                raise HTTPException(status_code=502,
+                                    detail=f"Incomplete documentation from GPT-4o ({finish_reason})")
+            yield "rst_ready", {"source": "generated", "truncated": truncated}
+
+        # 5. Generate HTML documentation with Sphinx (in-process, one build at a time)
+        build_path = "docs_build"
+        with sphinx_build_lock:
+            shutil.copyfile(tmp_rst if truncated else cached_rst, rst_file)
+            build_status = build_main(["-b", "html", docs_path, build_path])
+        if build_status != 0:
+            raise HTTPException(status_code=500, detail="Sphinx build failed")
+    finally:
+        if os.path.exists(tmp_rst):
+            os.remove(tmp_rst)
+    yield "built", build_path
 
     # 6. Provide a download link
-    return {"downloadUrl": "http://localhost:5000/docs_build/index.html"}
+    yield "done", DOWNLOAD_URL
+
+def sse_event(event, data):
+    # JSON-encode the payload so newlines in client input (e.g. repoUrl) can't forge extra events
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/generate-docs")
+def generate_docs(request: RepoRequest):
+    for _ in run_pipeline(request.repoUrl):
+        pass
+    return {"downloadUrl": DOWNLOAD_URL}
+
+@app.post("/generate-docs-stream")
+def generate_docs_stream(request: RepoRequest):
+    # Same pipeline as /generate-docs, reported as Server-Sent Events while it runs.
+    # This is a POST taking the RepoRequest JSON body, so browsers can't use EventSource:
+    # read it with fetch() and response.body.getReader() instead.
+    def events():
+        try:
+            for event, data in run_pipeline(request.repoUrl):
+                yield sse_event(event, data)
+        except HTTPException as e:
+            yield sse_event("error", e.detail)
+        except Exception:
+            # The 200 status line is already sent, so report the failure in-stream
+            logger.exception("Documentation generation failed for %r", request.repoUrl)
+            yield sse_event("error", "Documentation generation failed")
+
+    # Stop caches and reverse proxies from buffering the progress events
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})